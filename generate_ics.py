@@ -1,24 +1,61 @@
+import hashlib
+import json
 import re
-from datetime import datetime, timedelta
+from array import array
+from collections import deque
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from itertools import chain, islice
+from pathlib import Path
+from typing import Iterable, Iterator
 from zoneinfo import ZoneInfo
 
 import requests
 from bs4 import BeautifulSoup
-from ics import Calendar, Event
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 SOK_URL = "https://sok.se/olympiska-spel/tavlingar/spelen/milano-cortina-2026/svenska-os-guiden.html"
 TZ = ZoneInfo("Europe/Stockholm")
+# Spelen går 2026; körs skriptet senare antas innevarande år
+YEAR_GUESS = max(2026, datetime.now(TZ).year)
+PRODID = "-//frekkin-oss//os-sverige-kalender//SV"
+
+# Senast hämtade guiden + ETag/Last-Modified, så att en oförändrad sida ger 304 utan body
+CACHE_DIR = Path(__file__).resolve().parent
+CACHE_META = CACHE_DIR / "cache.json"
+
+# Delad session så att anslutningen (TCP + TLS) återanvänds vid omförsök och redirects
+_SESSION = requests.Session()
+_SESSION.headers.update({
+    "User-Agent": "Mozilla/5.0",
+    "Accept": "text/html",
+    "Accept-Encoding": "gzip, deflate, br",
+})
+_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=10,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+)
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.mount("https://", _ADAPTER)
 
-TIME_RE = re.compile(r"\b(\d{1,2})[:.](\d{2})\b")
+MONTH_ALT = (
+    r"jan(?:uari)?|feb(?:ruari)?|mar(?:s)?|apr(?:il)?|maj|jun(?:i)?|jul(?:i)?|aug(?:usti)?|"
+    r"sep(?:tember)?|okt(?:ober)?|nov(?:ember)?|dec(?:ember)?"
+)
 
-# Klarar både "5 februari" och "5 feb"
-DATE_RE = re.compile(
-    r"\b(\d{1,2})\s+"
-    r"(jan(?:uari)?|feb(?:ruari)?|mar(?:s)?|apr(?:il)?|maj|jun(?:i)?|jul(?:i)?|aug(?:usti)?|"
-    r"sep(?:tember)?|okt(?:ober)?|nov(?:ember)?|dec(?:ember)?)\b",
+# Datum ("5 februari" eller "5 feb") och tider ("12:30" eller "12.30") i ett och samma svep.
+# En tid får inte äta upp dagsiffrorna i ett datum ("10.05 feb" är 5 februari), därav lookahead.
+LINE_RE = re.compile(
+    r"(?P<date>\b(?P<day>\d{1,2})\s+(?P<month>" + MONTH_ALT + r")\b)"
+    r"|(?P<time>\b(?P<hh>\d{1,2})[:.](?P<mm>\d{2})\b(?!\s+(?:" + MONTH_ALT + r")\b))",
     re.IGNORECASE
 )
 
+# Billig förkontroll: utan månadsprefix eller ":"/"." kan LINE_RE inte matcha
+_MONTH_PREFIXES = ("jan", "feb", "mar", "apr", "maj", "jun", "jul", "aug", "sep", "okt", "nov", "dec")
+
 MONTHS = {
     "jan": 1, "januari": 1,
     "feb": 2, "februari": 2,
@@ -34,147 +71,244 @@ MONTHS = {
     "dec": 12, "december": 12,
 }
 
-# Tar bort tider och datum-fraser ur text så vi kan jämföra "samma aktivitet"
-def canonicalize_activity_text(s: str) -> str:
-    s = s.lower()
-    # bort med tider
-    s = re.sub(r"\b\d{1,2}[:.]\d{2}\b", " ", s)
-    # bort med veckodag (svenska) + datum ungefär
-    s = re.sub(r"\b(måndag|tisdag|onsdag|torsdag|fredag|lördag|söndag)\b", " ", s)
-    s = re.sub(r"\b\d{1,2}\b", " ", s)
-    s = re.sub(
-        r"\b(jan(?:uari)?|feb(?:ruari)?|mar(?:s)?|apr(?:il)?|maj|jun(?:i)?|jul(?:i)?|aug(?:usti)?|"
-        r"sep(?:tember)?|okt(?:ober)?|nov(?:ember)?|dec(?:ember)?)\b",
-        " ",
-        s,
-        flags=re.IGNORECASE,
-    )
-    # bort med separations-tecken
-    s = s.replace("|", " ")
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
-
+# Veckodagar och månadsnamn som ska bort ur aktivitetstexten
+_STOPWORDS = frozenset({
+    "måndag", "tisdag", "onsdag", "torsdag", "fredag", "lördag", "söndag",
+    *MONTHS,
+})
 
-def fetch_html(url: str) -> str:
-    r = requests.get(url, timeout=30, headers={"User-Agent": "Mozilla/5.0"})
-    r.raise_for_status()
-    return r.text
+# Ord delas på samma gränser som regexens \b, så "15:00-16:30", "feb." och "(3)" blir egna ord.
+# En tid "12:30" blir då två korta tal och försvinner via siffer-regeln.
+_WORD_RE = re.compile(r"\w+")
 
 
-def normalize_whitespace(s: str) -> str:
-    return re.sub(r"\s+", " ", s).strip()
+@dataclass
+class Event:
+    name: str
+    begin: datetime
+    end: datetime
+    description: str
+    uid: str = ""
 
 
-def extract_lines(html: str) -> list[str]:
-    soup = BeautifulSoup(html, "html.parser")
-    text = soup.get_text("\n")
-    lines = [normalize_whitespace(x) for x in text.split("\n")]
-    return [x for x in lines if x]
+# Tar bort tider och datum-fraser ur text så vi kan jämföra "samma aktivitet"
+def canonicalize_activity_text(s: str) -> str:
+    return " ".join(
+        t for t in _WORD_RE.findall(s.lower())
+        if t not in _STOPWORDS
+        and not (t.isdecimal() and len(t) <= 2)
+    )
 
 
-def parse_date_from_line(line: str, default_year: int) -> datetime | None:
-    m = DATE_RE.search(line)
-    if not m:
+def load_cache_meta(url: str) -> dict | None:
+    try:
+        meta = json.loads(CACHE_META.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
         return None
-    day = int(m.group(1))
-    month_name = m.group(2).lower()
-    month_key = month_name[:3]
-    month = MONTHS.get(month_key) or MONTHS.get(month_name)
-    if not month:
+    if meta.get("url") != url or not (CACHE_DIR / meta.get("body_path", "")).is_file():
         return None
-    return datetime(default_year, month, day, 0, 0, tzinfo=TZ)
-
-
-def parse_time_from_line(line: str) -> tuple[int, int] | None:
-    m = TIME_RE.search(line)
-    if not m:
-        return None
-    hh = int(m.group(1))
-    mm = int(m.group(2))
-    if 0 <= hh <= 23 and 0 <= mm <= 59:
-        return hh, mm
-    return None
-
+    return meta
+
+
+# Returnerar råa bytes så att BeautifulSoup själv känner av teckenkodningen (ingen extra avkodning)
+def fetch_bytes(url: str) -> bytes:
+    meta = load_cache_meta(url)
+    headers = {}
+    if meta:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    r = _SESSION.get(url, timeout=30, headers=headers)
+    if r.status_code == 304 and meta:
+        return (CACHE_DIR / meta["body_path"]).read_bytes()
+    r.raise_for_status()
 
-def build_events(lines: list[str]) -> list[Event]:
-    now = datetime.now(TZ)
-    year_guess = 2026 if now.year <= 2026 else now.year
+    body = r.content
+    body_path = "cache.html"
+    (CACHE_DIR / body_path).write_bytes(body)
+    CACHE_META.write_text(json.dumps({
+        "url": url,
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+        "body_path": body_path,
+    }), encoding="utf-8")
+    return body
 
-    current_date: datetime | None = None
-    provisional: list[Event] = []
 
-    for i, line in enumerate(lines):
-        dt = parse_date_from_line(line, year_guess)
+def normalize_whitespace(s: str) -> str:
+    return " ".join(s.split())
+
+
+def iter_lines(html: bytes) -> Iterator[str]:
+    text = BeautifulSoup(html, "lxml").get_text("\n")
+    for m in re.finditer(r"[^\n]+", text):
+        s = normalize_whitespace(m.group())
+        if s:
+            yield s
+
+
+# Rullande fönster: två rader bakåt och aktuell rad + tre framåt (samma som lines[i-2:i+4]).
+# Dequerna återanvänds, så de måste läsas innan nästa steg i iterationen.
+def iter_windows(lines: Iterable[str]) -> Iterator[tuple[deque[str], deque[str]]]:
+    it = iter(lines)
+    behind: deque[str] = deque(maxlen=2)
+    ahead: deque[str] = deque(islice(it, 4))
+    while ahead:
+        yield behind, ahead
+        behind.append(ahead.popleft())
+        ahead.extend(islice(it, 1))
+
+
+# Ett datum på raden vinner över en tid, precis som när raden är en dagsrubrik.
+def parse_line(line: str, default_year: int) -> tuple[date | None, tuple[int, int] | None]:
+    if ":" not in line and "." not in line:
+        lower = line.lower()
+        if not any(mo in lower for mo in _MONTH_PREFIXES):
+            return None, None
+
+    first_time = None
+    for m in LINE_RE.finditer(line):
+        if m.group("date"):
+            month_name = m.group("month").lower()
+            month = MONTHS.get(month_name[:3]) or MONTHS.get(month_name)
+            if month:
+                return date(default_year, month, int(m.group("day"))), None
+        elif first_time is None:
+            first_time = m
+
+    if first_time is None:
+        return None, None
+    hh = int(first_time.group("hh"))
+    mm = int(first_time.group("mm"))
+    if 0 <= hh <= 23 and 0 <= mm <= 59:
+        return None, (hh, mm)
+    return None, None
+
+
+def build_events(lines: Iterable[str]) -> list[Event]:
+    current_date: date | None = None
+    # Kandidaterna lagras kolumnvis; datetime och Event skapas först för dem som överlever dedupen.
+    days = array("i")  # datum som ordinal
+    mins = array("H")  # minuter efter midnatt
+    titles: list[str] = []
+    descriptions: list[str] = []
+    canon_names: list[str] = []
+    canon_fulls: list[str] = []
+
+    for behind, ahead in iter_windows(lines):
+        line = ahead[0]
+        dt, t = parse_line(line, YEAR_GUESS)
         if dt:
             current_date = dt
             continue
 
-        t = parse_time_from_line(line)
         if not t or not current_date:
             continue
 
         hh, mm = t
-        start = current_date.replace(hour=hh, minute=mm)
 
         # Titel: om raden bara är "12.30" eller "12:30", ta med nästa rad.
         title = line
-        if len(title) <= 6 and i + 1 < len(lines):
-            title = f"{line} {lines[i+1]}"
+        if len(title) <= 6 and len(ahead) > 1:
+            title = f"{line} {ahead[1]}"
         title = normalize_whitespace(title)
 
         # Beskrivning: lite kontext runt raden
-        window = []
-        for j in range(max(0, i - 2), min(len(lines), i + 4)):
-            window.append(lines[j])
-        description = normalize_whitespace(" | ".join(window))
+        description = normalize_whitespace(" | ".join(chain(behind, ahead)))
 
-        end = start + timedelta(minutes=60)
-
-        e = Event()
-        e.name = title
-        e.begin = start
-        e.end = end
-        e.description = description
-        provisional.append(e)
+        days.append(current_date.toordinal())
+        mins.append(hh * 60 + mm)
+        titles.append(title)
+        descriptions.append(description)
+        canon_names.append(canonicalize_activity_text(title))
+        canon_fulls.append(canonicalize_activity_text(f"{title} {description}"))
 
     # Deduplicering:
     # Om flera events samma dag beskriver samma aktivitet, behåll det tidigaste (starten).
-    chosen: dict[tuple[str, str], Event] = {}
-    for e in provisional:
-        day_key = e.begin.astimezone(TZ).strftime("%Y-%m-%d")
-        activity_key = canonicalize_activity_text(f"{e.name} {e.description}")
-        key = (day_key, activity_key)
-
-        if key not in chosen:
-            chosen[key] = e
-            continue
+    chosen: dict[tuple[int, str], int] = {}
+    for idx, canon_full in enumerate(canon_fulls):
+        key = (days[idx], canon_full)
+
+        existing = chosen.get(key)
+        if existing is None or mins[idx] < mins[existing]:
+            chosen[key] = idx
+
+    # Stabil UID efter dedupe, sorterat snyggt på starttid
+    final_events: list[Event] = []
+    for idx in sorted(chosen.values(), key=lambda k: days[k] * 1440 + mins[k]):
+        hh, mm = divmod(mins[idx], 60)
+        d = date.fromordinal(days[idx])
+        start = datetime(d.year, d.month, d.day, hh, mm, tzinfo=TZ)
+        # hash() saltas per process (PYTHONHASHSEED); blake2b ger samma UID mellan körningar
+        uid_key = f"{start.isoformat()}|{canon_names[idx]}".encode("utf-8")
+        final_events.append(Event(
+            name=titles[idx],
+            begin=start,
+            end=start + timedelta(minutes=60),
+            description=descriptions[idx],
+            uid=f"{hashlib.blake2b(uid_key, digest_size=8).hexdigest()}@os-sverige-kalender",
+        ))
+    return final_events
+
 
-        existing = chosen[key]
-        if e.begin < existing.begin:
-            chosen[key] = e
+# RFC 5545: TEXT-värden escapas och rader viks efter 75 oktetter (fortsättningsrader börjar med mellanslag)
+def escape_text(s: str) -> str:
+    return (
+        s.replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
 
-    # Stabil UID efter dedupe
-    final_events = list(chosen.values())
-    for e in final_events:
-        uid_key = f"{e.begin.astimezone(TZ).isoformat()}|{canonicalize_activity_text(e.name)}"
-        e.uid = f"{hash(uid_key)}@os-sverige-kalender"
 
-    # Sortera snyggt
-    final_events.sort(key=lambda x: x.begin)
-    return final_events
+def fold_line(line: str) -> str:
+    if len(line.encode("utf-8")) <= 75:
+        return line + "\r\n"
 
+    parts: list[str] = []
+    buf = ""
+    size = 0
+    for ch in line:
+        n = len(ch.encode("utf-8"))
+        if size + n > 75:
+            parts.append(buf)
+            buf = " "
+            size = 1
+        buf += ch
+        size += n
+    parts.append(buf)
+    return "\r\n".join(parts) + "\r\n"
 
-def main() -> int:
-    html = fetch_html(SOK_URL)
-    lines = extract_lines(html)
-    events = build_events(lines)
 
-    cal = Calendar()
+def format_utc(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def serialize_iter(events: list[Event]) -> Iterator[str]:
+    dtstamp = format_utc(datetime.now(TZ))
+    yield f"BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:{PRODID}\r\n"
     for e in events:
-        cal.events.add(e)
+        yield "BEGIN:VEVENT\r\n"
+        yield fold_line(f"UID:{e.uid}")
+        yield f"DTSTAMP:{dtstamp}\r\n"
+        yield f"DTSTART:{format_utc(e.begin)}\r\n"
+        yield f"DTEND:{format_utc(e.end)}\r\n"
+        yield fold_line(f"SUMMARY:{escape_text(e.name)}")
+        yield fold_line(f"DESCRIPTION:{escape_text(e.description)}")
+        yield "END:VEVENT\r\n"
+    yield "END:VCALENDAR\r\n"
+
+
+def main() -> int:
+    html = fetch_bytes(SOK_URL)
+    events = build_events(iter_lines(html))
 
-    with open("svenska-os-starter.ics", "w", encoding="utf-8") as f:
-        f.writelines(cal.serialize_iter())
+    # Hela kalendern byggs i minnet och skrivs med ett enda write()
+    with open("svenska-os-starter.ics", "w", encoding="utf-8", newline="") as f:
+        f.write("".join(serialize_iter(events)))
 
     print(f"Skapade {len(events)} events i svenska-os-starter.ics")
     return 0